@@ -7,9 +7,13 @@
 
 import ollama #qwen3-coder:30b
 from ollama._types import ChatResponse
+import ast
 import json
 import re
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import docker
 import git
@@ -49,17 +53,62 @@ class BasicActionLLM:
             print(f"Ошибка при обращении к LLM: {str(e)}")
             return final_response, ""
 
+    def stream_llm_response(self, prompt: str, role='user'):
+        # Отдает ответ LLM по частям, по мере генерации
+        self.add_to_context(role, prompt)
+        try:
+            client = ollama.Client(host=os.getenv('HOST_PORT_OLLAMA'))
+            chunks = client.chat(
+                model=os.getenv('OLLAMA_MODEL'),
+                messages=self.conversation_history,
+                stream=True,
+            )
+            try:
+                for chunk in chunks:
+                    yield chunk.message.content or ""
+            finally:
+                # Закрываем поток, если ответ больше не нужен
+                chunks.close()
+        except Exception as e:
+            print(f"Ошибка при обращении к LLM: {str(e)}")
+            # Пустой ответ не должен выглядеть как успешный
+            raise
+
     def clean_response(self, llm_response: str):
         return re.sub(r"<think>.*?</think>", "", llm_response, flags=re.DOTALL).strip()
 
 class CodeWriteCodeCheckf():
-    def __init__(self):
+    # Сколько классов и методов в последнем классе нужно увидеть в потоке,
+    # чтобы начать генерацию тестов не дожидаясь конца кода
+    min_classes_for_tests = 2
+    min_methods_for_tests = 3
+
+    code_promt = "создай несколько классов и в них по 3-5 методов на Python. классы должны быть связаны между собой и иметь некую полезную работу. Нужен только, код без объяснений!!!!"
+    test_promt = '''
+        1. напиши unit тесты к коду c использованием unittest. 
+        2. не забудь импорты от классов кода который будет проверятся! 
+        3. сделай импорт code_from_test и всех классов
+        4. НЕ вставлях исходный код классов которые необходимо проверить
+        5. Убедись что все импорты правильно указаны!
+        6. Проверь корректность тестов
+        7. тесты должны сами запускаться при выполнении файла'''
+
+    def __init__(self, pipelined=None):
         self.ai = BasicActionLLM()
+        # Генерация тестов параллельно с генерацией кода, PIPELINED_DIALOG=1 в .env.
+        # Нужен ollama с OLLAMA_NUM_PARALLEL>=2, иначе запрос тестов встает
+        # в очередь за генерацией кода и режим работает медленнее обычного
+        if pipelined is None:
+            pipelined = os.getenv('PIPELINED_DIALOG', '0') == '1'
+        self.pipelined = pipelined
     
     def start_dialog(self):
+        if self.pipelined:
+            return self.start_dialog_pipelined()
         print('Генерирую конесколько классов и в них по 3-5 методов')
-        promt = "создай несколько классов и в них по 3-5 методов на Python. классы должны быть связаны между собой и иметь некую полезную работу. Нужен только, код без объяснений!!!!"
-        result = self.ai.get_llm_response(promt)
+        start = time.perf_counter()
+        result = self.ai.get_llm_response(self.code_promt)
+        print(f'Код получен за {time.perf_counter() - start:.1f} с')
         self.ai.add_to_context("assistant", result.message.content)
         code = re.sub(r'^```python\s*|\s*```$', '', result.message.content, flags=re.MULTILINE)
         code = re.sub(r'^\s*```python\s*|\s*```\s*$', '', code, flags=re.MULTILINE)
@@ -68,15 +117,9 @@ class CodeWriteCodeCheckf():
         with open("code_from_test.py", "w") as file:
             file.write(code)
         print('Формирую тесты для полученного кода')
-        promt = '''
-        1. напиши unit тесты к коду c использованием unittest. 
-        2. не забудь импорты от классов кода который будет проверятся! 
-        3. сделай импорт code_from_test и всех классов
-        4. НЕ вставлях исходный код классов которые необходимо проверить
-        5. Убедись что все импорты правильно указаны!
-        6. Проверь корректность тестов
-        7. тесты должны сами запускаться при выполнении файла'''
-        result = self.ai.get_llm_response(promt)
+        phase = time.perf_counter()
+        result = self.ai.get_llm_response(self.test_promt)
+        print(f'Тесты получены через {time.perf_counter() - phase:.1f} с после кода')
         test_code = re.sub(r'^```python\s*|\s*```$', '', result.message.content, flags=re.MULTILINE)
         #test_code = re.sub(r'^\s*```python\s*|\s*```\s*$', '', test_code, flags=re.MULTILINE)
         print('Получил тесты, записываю в файл')
@@ -86,12 +129,18 @@ class CodeWriteCodeCheckf():
             file.write(test_code)
         print('Запускаю тесты')
         doc = DockerRun()
+        phase = time.perf_counter()
         result_run_text, error_run_test = doc.run_file_python("test_code.py")
         print(result_run_text)
+        print(f'Тесты выполнены за {time.perf_counter() - phase:.1f} с')
+        self.fix_tests_and_release(doc, result.message.content, result_run_text, error_run_test)
+        print(f'Сессия заняла {time.perf_counter() - start:.1f} с')
+
+    def fix_tests_and_release(self, doc, test_answer: str, result_run_text: str, error_run_test: bool):
         if error_run_test:
             print('Исправляю тесты, записываю в файл')
             promt = f"Исправь юнит тесты! Ошибка: {result_run_text}"
-            self.ai.add_to_context("assistant", result.message.content)
+            self.ai.add_to_context("assistant", test_answer)
             result = self.ai.get_llm_response(promt)
             test_code = re.sub(r'^```python\s*|\s*```$', '', result.message.content, flags=re.MULTILINE)
             #test_code = re.sub(r'^\s*```python\s*|\s*```\s*$', '', test_code, flags=re.MULTILINE)
@@ -116,6 +165,271 @@ class CodeWriteCodeCheckf():
             print("Создаем релиз и тэг на GitHub")
             Jobs.release()
 
+    def start_dialog_pipelined(self):
+        print('Генерирую конесколько классов и в них по 3-5 методов, тесты формирую параллельно')
+        start = time.perf_counter()
+        doc = DockerRun()
+        pool = ThreadPoolExecutor(max_workers=2)
+        cancel = threading.Event()
+        try:
+            test_answer = self.generate_code_and_tests(pool, cancel, start)
+        finally:
+            # Прерываем спекулятивные запросы, результат которых уже не нужен
+            cancel.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+        if test_answer is None:
+            return
+        test_code = re.sub(r'^```python\s*|\s*```$', '', test_answer, flags=re.MULTILINE)
+        if 'unittest' not in test_code:
+            print('LLM не вернула тесты, тесты не запускаю')
+            return
+        print('Получил тесты, записываю в файл')
+        if os.path.exists('test_code.py'):
+            os.remove("test_code.py")
+        with open("test_code.py", "w") as file:
+            file.write(test_code)
+        try:
+            ast.parse(test_code)
+        except SyntaxError as e:
+            print(f'Синтаксическая ошибка в тестах: {e}')
+            self.fix_tests_and_release(doc, test_answer, f"Синтаксическая ошибка: {e}", True)
+            print(f'Сессия заняла {time.perf_counter() - start:.1f} с')
+            return
+        print('Запускаю тесты')
+        phase = time.perf_counter()
+        result_run_text, error_run_test = doc.run_file_python("test_code.py")
+        print(result_run_text)
+        print(f'Тесты выполнены за {time.perf_counter() - phase:.1f} с')
+        self.fix_tests_and_release(doc, test_answer, result_run_text, error_run_test)
+        print(f'Сессия заняла {time.perf_counter() - start:.1f} с')
+
+    def generate_code_and_tests(self, pool, cancel, start: float):
+        # Возвращает ответ LLM с тестами или None, если продолжать нельзя
+        answer = ""
+        signatures = {}
+        tests_future = None
+        try:
+            for part in self.ai.stream_llm_response(self.code_promt):
+                answer += part
+                # Разбираем заново только когда пришла новая полная строка
+                if tests_future is None and '\n' in part:
+                    prefix = answer[:answer.rfind('\n') + 1]
+                    signatures = self.parse_signatures(prefix)
+                    if self.signatures_ready(signatures):
+                        print(f'Сигнатуры классов получены за {time.perf_counter() - start:.1f} с, формирую тесты не дожидаясь кода')
+                        tests_future = pool.submit(self.generate_tests, prefix, cancel)
+        except Exception:
+            print('Генерация кода прервана, тесты не запускаю')
+            return None
+        print(f'Код получен за {time.perf_counter() - start:.1f} с')
+        self.ai.add_to_context("assistant", answer)
+        code = re.sub(r'^```python\s*|\s*```$', '', answer, flags=re.MULTILINE)
+        code = re.sub(r'^\s*```python\s*|\s*```\s*$', '', code, flags=re.MULTILINE)
+        try:
+            final = self.code_signatures(code)
+        except SyntaxError as e:
+            print(f'Код содержит синтаксические ошибки, тесты не запускаю: {e}')
+            return None
+        if not final:
+            print('LLM не вернула классы, тесты не запускаю')
+            return None
+        if os.path.exists('code_from_test.py'):
+            os.remove("code_from_test.py")
+        with open("code_from_test.py", "w") as file:
+            file.write(code)
+        phase = time.perf_counter()
+        try:
+            if tests_future is None:
+                print('Формирую тесты для полученного кода')
+                test_answer = "".join(self.ai.stream_llm_response(self.test_promt))
+            else:
+                # Сверяем сигнатуры, по которым писались тесты, с итоговым кодом
+                changed, extra = self.signatures_diff(signatures, final)
+                if changed:
+                    print('Сигнатуры в итоговом коде изменились, формирую тесты заново')
+                    cancel.set()
+                    test_answer = "".join(self.ai.stream_llm_response(self.test_promt))
+                elif extra:
+                    print('Дописываю тесты для классов и методов, полученных после начала генерации тестов')
+                    extra_future = pool.submit(
+                        self.generate_extra_tests, list(self.ai.conversation_history), extra, cancel)
+                    test_answer = self.merge_tests(tests_future.result(), extra_future.result())
+                    if test_answer is None:
+                        print('Не удалось объединить тесты, формирую тесты заново')
+                        test_answer = "".join(self.ai.stream_llm_response(self.test_promt))
+                    else:
+                        self.ai.add_to_context("user", self.test_promt)
+                else:
+                    test_answer = tests_future.result()
+                    self.ai.add_to_context("user", self.test_promt)
+        except Exception:
+            print('Генерация тестов прервана, тесты не запускаю')
+            return None
+        print(f'Тесты получены через {time.perf_counter() - phase:.1f} с после кода')
+        return test_answer
+
+    def generate_tests(self, code_prefix: str, cancel) -> str:
+        # Отдельный контекст, чтобы не мешать потоку генерации кода
+        ai = BasicActionLLM()
+        code_prefix = re.sub(r'^\s*```python\s*|\s*```\s*$', '', code_prefix, flags=re.MULTILINE)
+        promt = f"{self.test_promt}\n        8. Код code_from_test получен не полностью, пиши тесты только для полностью полученных методов:\n{code_prefix}"
+        return self.collect_response(ai.stream_llm_response(promt), cancel)
+
+    def generate_extra_tests(self, history: list, extra: dict, cancel) -> str:
+        # Контекст с итоговым кодом, тесты только для недостающих сигнатур
+        ai = BasicActionLLM()
+        ai.conversation_history = history
+        promt = f"{self.test_promt}\n        8. Напиши тесты только для этих классов и методов:\n{self.format_signatures(extra)}"
+        return self.collect_response(ai.stream_llm_response(promt), cancel)
+
+    @staticmethod
+    def collect_response(chunks, cancel) -> str:
+        # Собирает ответ, пока запрос не отменен
+        answer = ""
+        try:
+            for part in chunks:
+                if cancel.is_set():
+                    break
+                answer += part
+        finally:
+            chunks.close()
+        return answer
+
+    def signatures_ready(self, signatures: dict) -> bool:
+        if len(signatures) < self.min_classes_for_tests:
+            return False
+        last_class = list(signatures.values())[-1]
+        return len(last_class) >= self.min_methods_for_tests
+
+    @staticmethod
+    def parse_signatures(code: str):
+        # Сигнатуры по строкам, код может быть получен не полностью
+        signatures = {}
+        methods = None
+        body_indent = None
+        for line in code.split('\n'):
+            if not line.strip():
+                continue
+            indent = len(line) - len(line.lstrip())
+            class_match = re.match(r'^class\s+(\w+)\b.*:', line)
+            if class_match:
+                methods = signatures.setdefault(class_match.group(1), {})
+                body_indent = None
+                continue
+            if indent == 0:
+                methods = None
+                continue
+            if methods is None:
+                continue
+            if body_indent is None:
+                body_indent = indent
+            # Только методы класса, вложенные функции пропускаем
+            def_match = re.match(r'^\s+(?:async\s+)?def\s+(\w+)\s*\((.*?)\)\s*(?:->[^:]*)?:', line)
+            if def_match and indent == body_indent:
+                methods[def_match.group(1)] = CodeWriteCodeCheckf.normalize_args(def_match.group(2))
+        return signatures
+
+    @staticmethod
+    def normalize_args(args: str) -> str:
+        try:
+            return ast.unparse(ast.parse(f"def f({args}): pass").body[0].args)
+        except SyntaxError:
+            return args.strip()
+
+    @staticmethod
+    def code_signatures(code: str) -> dict:
+        signatures = {}
+        for node in ast.parse(code).body:
+            if isinstance(node, ast.ClassDef):
+                signatures[node.name] = {
+                    item.name: ast.unparse(item.args)
+                    for item in node.body
+                    if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef))
+                }
+        return signatures
+
+    @staticmethod
+    def signatures_diff(signatures: dict, final: dict):
+        # changed - протестированные сигнатуры изменились или пропали,
+        # extra - сигнатуры, для которых тестов еще нет
+        changed = any(
+            class_name not in final or final[class_name].get(method_name) != args
+            for class_name, methods in signatures.items()
+            for method_name, args in methods.items()
+        )
+        extra = {}
+        for class_name, methods in final.items():
+            tested = signatures.get(class_name)
+            missing = {name: args for name, args in methods.items() if tested is None or name not in tested}
+            if tested is None or missing:
+                extra[class_name] = missing
+        return changed, extra
+
+    @staticmethod
+    def format_signatures(signatures: dict) -> str:
+        skeleton = []
+        for class_name, methods in signatures.items():
+            skeleton.append(f"class {class_name}:")
+            for method_name, args in methods.items():
+                skeleton.append(f"    def {method_name}({args}):")
+        return "\n".join(skeleton)
+
+    @staticmethod
+    def merge_tests(test_answer: str, extra_answer: str):
+        # Добавляет код из extra_answer перед блоком запуска тестов
+        test_code = re.sub(r'^```python\s*|\s*```$', '', test_answer, flags=re.MULTILINE)
+        extra_code = re.sub(r'^```python\s*|\s*```$', '', extra_answer, flags=re.MULTILINE)
+        try:
+            tree = ast.parse(test_code)
+            extra = ast.parse(extra_code)
+        except SyntaxError:
+            return None
+        imports = {ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))}
+        definitions = {
+            node.name: node for node in tree.body
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef))
+        }
+        module_hooks = ('setUpModule', 'tearDownModule')
+        renames = {}
+        nodes = []
+        for node in extra.body:
+            if CodeWriteCodeCheckf.is_main_block(node):
+                continue
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
+                if ast.unparse(node) not in imports:
+                    nodes.append(node)
+                continue
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) and node.name in definitions:
+                existing = definitions[node.name]
+                if node.name in module_hooks and isinstance(existing, ast.FunctionDef):
+                    # unittest вызывает только функцию с этим именем, объединяем тела
+                    existing.body.extend(node.body)
+                    continue
+                new_name = node.name
+                while new_name in definitions:
+                    new_name += 'Extra'
+                renames[node.name] = new_name
+                node.name = new_name
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                definitions[node.name] = node
+            nodes.append(node)
+        # Переименовываем и ссылки на переименованные классы и функции
+        for node in nodes:
+            for child in ast.walk(node):
+                if isinstance(child, ast.Name) and child.id in renames:
+                    child.id = renames[child.id]
+        index = len(tree.body)
+        for i, node in enumerate(tree.body):
+            if CodeWriteCodeCheckf.is_main_block(node):
+                index = i
+                break
+        tree.body[index:index] = nodes
+        return ast.unparse(tree)
+
+    @staticmethod
+    def is_main_block(node) -> bool:
+        return isinstance(node, ast.If) and '__name__' in ast.unparse(node.test)
+
 class DockerRun(BasicActionLLM):
     def __init__(self):
         self.model = os.getenv('OLLAMA_MODEL')